@@ -1,3 +1,5 @@
+import os
+
 from langchain.document_loaders import CSVLoader, UnstructuredWordDocumentLoader, UnstructuredEPubLoader, \
     PDFMinerLoader, UnstructuredMarkdownLoader, TextLoader
 
@@ -23,8 +25,31 @@ DEFAULT_CONFIG = {
     "repo_path": None,
     "venv_path": None,
     "temperature": "0.7",
+    "index_type": "flat",
+    "nlist": "256",
+    "pq_m": "32",
+    "nprobe": "8",
+    "embedding_backend": "torch",
+    "quantize_embeddings": "false",
+    "compile_embeddings": "false",
+    "embedding_model": "text-embedding-3-small",
+    "embedding_dim": "512",
+    "n_batch": "512",
+}
+
+# USD per 1k tokens
+EMBEDDING_PRICES = {
+    "text-embedding-ada-002": 0.0001,
+    "text-embedding-3-small": 0.00002,
+    "text-embedding-3-large": 0.00013,
 }
 
+CHUNK_MANIFEST = "chunks.json"
+STORE_METADATA = "store.json"
+SPLITS_CACHE = "splits_cache.sqlite"
+EMBED_BATCH_SIZE = 512
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "talk_codebase", "onnx")
+
 LOADER_MAPPING = {
     ".csv": {
         "loader": CSVLoader,
@@ -0,0 +1,156 @@
+# embeddings.py
+
+import os
+import sys
+import weakref
+from typing import Any, List
+
+import numpy as np
+import torch
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.embeddings.base import Embeddings
+from sentence_transformers.models import Pooling
+
+from consts import ONNX_CACHE_DIR
+from utils import is_enabled
+
+
+def mean_pool(last_hidden_state, attention_mask):
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    embeddings = (last_hidden_state * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+    return torch.nn.functional.normalize(embeddings, p=2, dim=1)
+
+
+class FusedMeanPooling(torch.nn.Module):
+    # Drop-in for sentence-transformers' mean Pooling module that pools and normalizes in one tensor expression
+
+    def __init__(self, embedding_dimension: int):
+        super().__init__()
+        self.embedding_dimension = embedding_dimension
+        self.pool = mean_pool
+
+    def forward(self, features):
+        features["sentence_embedding"] = self.pool(features["token_embeddings"], features["attention_mask"])
+        return features
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.embedding_dimension
+
+
+class SortedBatchHuggingFaceEmbeddings(HuggingFaceEmbeddings):
+    batch_size: int = 64
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        torch.set_num_threads(os.cpu_count())
+        for name, module in self.client.named_children():
+            if isinstance(module, Pooling) and module.get_pooling_mode_str() == "mean":
+                self.client._modules[name] = FusedMeanPooling(module.get_sentence_embedding_dimension())
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [text.replace("\n", " ") for text in texts]
+        # encode already batches inputs in length order and restores the original order
+        return self.client.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                  normalize_embeddings=True).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.encode(text.replace("\n", " "), convert_to_numpy=True, normalize_embeddings=True).tolist()
+
+
+class QuantizedMiniLMEmbeddings(SortedBatchHuggingFaceEmbeddings):
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        # int8 weights for every Linear layer, activations are quantized on the fly
+        self.client = torch.quantization.quantize_dynamic(self.client, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class ONNXMiniLMEmbeddings(Embeddings):
+
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", batch_size: int = 64):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.batch_size = batch_size
+        save_dir = os.path.join(ONNX_CACHE_DIR, model_name.replace("/", "--"))
+        if os.path.isdir(save_dir):
+            self.model = ORTModelForFeatureExtraction.from_pretrained(save_dir, provider="CPUExecutionProvider")
+            self.tokenizer = AutoTokenizer.from_pretrained(save_dir)
+        else:
+            self.model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True,
+                                                                      provider="CPUExecutionProvider")
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.model.save_pretrained(save_dir)
+            self.tokenizer.save_pretrained(save_dir)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(texts, padding=True, truncation=True, return_tensors="np")
+        last_hidden_state = self.model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"][..., None].astype(last_hidden_state.dtype)
+        embeddings = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [text.replace("\n", " ") for text in texts]
+        order = np.argsort([len(text) for text in texts])
+        embeddings = np.empty((len(texts), self.model.config.hidden_size), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            embeddings[batch] = self._encode([texts[i] for i in batch])
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text.replace("\n", " ")])[0].tolist()
+
+
+# Loaded embedders, kept alive only as long as a vector store still references them
+_local_embeddings = weakref.WeakValueDictionary()
+
+
+def create_local_embeddings(config, model_name='all-MiniLM-L6-v2'):
+    key = (model_name, config.get("embedding_backend"), is_enabled(config, "quantize_embeddings"),
+           is_enabled(config, "compile_embeddings"))
+    embeddings = _local_embeddings.get(key)
+    if embeddings is None:
+        embeddings = _build_local_embeddings(model_name, config)
+        _local_embeddings[key] = embeddings
+    return embeddings
+
+
+def _build_local_embeddings(model_name, config):
+    if config.get("embedding_backend") == "onnx":
+        try:
+            return ONNXMiniLMEmbeddings(f"sentence-transformers/{model_name}")
+        except ImportError:
+            sys.stderr.write("optimum[onnxruntime] is not installed, falling back to the torch embedder")
+    if is_enabled(config, "quantize_embeddings"):
+        # int8 dynamic quantization only has CPU kernels
+        embeddings = QuantizedMiniLMEmbeddings(model_name=model_name)
+    elif torch.cuda.is_available():
+        embeddings = SortedBatchHuggingFaceEmbeddings(model_name=model_name, model_kwargs={'device': 'cuda'},
+                                                      batch_size=256)
+    else:
+        embeddings = SortedBatchHuggingFaceEmbeddings(model_name=model_name)
+    if is_enabled(config, "compile_embeddings"):
+        compile_embeddings(embeddings)
+    return embeddings
+
+
+def compile_embeddings(embeddings):
+    if not hasattr(torch, "compile"):
+        return
+    transformer = embeddings.client[0]
+    auto_model = transformer.auto_model
+    poolings = [module for module in embeddings.client.children() if isinstance(module, FusedMeanPooling)]
+    try:
+        transformer.auto_model = torch.compile(auto_model, mode="reduce-overhead", dynamic=True)
+        for pooling in poolings:
+            pooling.pool = torch.compile(mean_pool, dynamic=True)
+        # Compilation is lazy, the warm-up forwards pay for it (and surface failures) up front
+        for _ in range(2):
+            embeddings.client.encode(["warm up"], convert_to_numpy=True)
+    except Exception as e:
+        sys.stderr.write(f"Could not compile the embedding model, using eager mode: {e}")
+        transformer.auto_model = auto_model
+        for pooling in poolings:
+            pooling.pool = mean_pool
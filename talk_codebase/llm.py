@@ -4,24 +4,26 @@ import sys
 import os
 from typing import Optional
 import json
-from halo import Halo
 from langchain import FAISS
 from langchain import PromptTemplate, LLMChain
 from langchain.callbacks.manager import CallbackManager
 from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings
 from langchain.llms import GPT4All
 from langchain.schema import HumanMessage, SystemMessage
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from consts import MODEL_TYPES
-from utils import load_files, get_local_vector_store, calculate_cost, StreamStdOutJSON
+from consts import MODEL_TYPES, SPLITS_CACHE
+from openai_embeddings import AsyncBatchOpenAIEmbeddings
+from utils import load_files, get_local_vector_store, calculate_cost, StreamStdOutJSON, create_vector_store, \
+    set_nprobe, check_faiss_simd, SplitCache, chunk_hash, load_chunk_manifest, save_chunk_manifest, \
+    remove_from_vector_store, add_to_vector_store, load_and_embed, reopen_writable, supports_removal, embed_texts, \
+    save_store_metadata, load_store_metadata
 
 
 class BaseLLM:
 
     def __init__(self, root_dir, config):
         self.config = config
+        check_faiss_simd()
         self.llm = self._create_model()
         self.root_dir = root_dir
         self.vector_store = self._create_store(root_dir)
@@ -35,45 +37,101 @@ class BaseLLM:
     def embedding_search(self, query, k):
         return self.vector_store.search(query, k=k, search_type="similarity")
 
-    def _create_vector_store(self, embeddings, index, root_dir, force_recreate:bool = False):     
+    def _create_vector_store(self, embeddings, index, root_dir, metadata, force_recreate:bool = False):     
         # Normalize the root directory path
         root_dir = os.path.normpath(root_dir)
         index_path = os.path.join(root_dir, "vector_store", index)
         
         if not force_recreate:
             new_db = get_local_vector_store(embeddings, index_path)
+            stored_metadata = load_store_metadata(index_path)
+            # Vectors from another model or dimension can't be searched or extended with this one
+            if new_db is not None and stored_metadata != metadata:
+                sys.stderr.write(f"Vector store was built with {stored_metadata} instead of {metadata}, recreating")
+                new_db = None
             if new_db is not None:
                 sys.stderr.write(f"Existing local vector store found: {new_db}")
-                return new_db
+                new_db = self._update_vector_store(new_db, embeddings, index, root_dir, index_path)
+                if new_db is not None:
+                    set_nprobe(new_db, int(self.config.get("nprobe")))
+                    return new_db
 
-        docs = load_files(root_dir)
-        if len(docs) == 0:
-            sys.stderr.write("✘ No documents found")
-            exit(0)
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=int(self.config.get("chunk_size")),
-                                                       chunk_overlap=int(self.config.get("chunk_overlap")))
-        texts = text_splitter.split_documents(docs)
+        split_cache = SplitCache(os.path.join(root_dir, "vector_store", SPLITS_CACHE), self.config)
         if index == MODEL_TYPES["OPENAI"]:
-            cost = calculate_cost(docs, self.config.get("model_name"))
+            # Split everything up front so the estimate is shown before any paid embedding request
+            texts = split_cache.split(load_files(root_dir))
+            if len(texts) == 0:
+                sys.stderr.write("✘ No documents found")
+                exit(0)
+            cost = calculate_cost(texts, self.config.get("embedding_model"))
             sys.stderr.write(f"Creating a vector store with estimated cost ~${cost:.5f}")
+            # Large enough batches that every call keeps all concurrent requests busy
+            vectors = embed_texts(texts, embeddings, embeddings.batch_size * embeddings.max_concurrency)
+        else:
+            texts, vectors = load_and_embed(root_dir, split_cache.split, embeddings)
+            if len(texts) == 0:
+                sys.stderr.write("✘ No documents found")
+                exit(0)
+
+        db = create_vector_store(texts, vectors, embeddings, self.config)
+        db.save_local(index_path)
+        save_chunk_manifest(db, index_path)
+        save_store_metadata(index_path, metadata)
+        set_nprobe(db, int(self.config.get("nprobe")))
+        return db
 
-        #spinners = Halo(text=f"Creating vector store", spinner='dots').start()
-        #sys.stderr.write('\r' + f'Loading files: {spinners}')
-        db = FAISS.from_documents(texts, embeddings)
-        db.add_documents(texts)
+    def _update_vector_store(self, db, embeddings, index, root_dir, index_path):
+        docs = load_files(root_dir)
+        if len(docs) == 0:
+            return db
+        current = {}
+        split_cache = SplitCache(os.path.join(root_dir, "vector_store", SPLITS_CACHE), self.config)
+        for text in split_cache.split(docs):
+            current.setdefault(text.metadata["source"], {})[chunk_hash(text.page_content)] = text
+        manifest = load_chunk_manifest(db, index_path)
+
+        stale_ids = [docstore_id
+                     for source, hashes in manifest.items()
+                     for digest, docstore_ids in hashes.items() if digest not in current.get(source, {})
+                     for docstore_id in docstore_ids]
+        new_texts = [text
+                     for source, texts in current.items()
+                     for digest, text in texts.items() if digest not in manifest.get(source, {})]
+        if not stale_ids and not new_texts:
+            return db
+
+        if stale_ids and not supports_removal(db):
+            sys.stderr.write("Vector store does not support removing chunks, recreating it")
+            return None
+
+        sys.stderr.write(f"Updating vector store: {len(stale_ids)} stale chunks, {len(new_texts)} new chunks")
+        reopen_writable(db, index_path)
+        # Every chunk is inserted exactly once: drop the stale ones, then add only the new ones
+        if stale_ids:
+            remove_from_vector_store(db, stale_ids)
+        if new_texts:
+            if index == MODEL_TYPES["OPENAI"]:
+                cost = calculate_cost(new_texts, self.config.get("embedding_model"))
+                sys.stderr.write(f"Embedding new chunks with estimated cost ~${cost:.5f}")
+            add_to_vector_store(db, new_texts, embeddings)
         db.save_local(index_path)
-        #spinners.succeed(f"Created vector store for {len(docs)} documents")
+        save_chunk_manifest(db, index_path)
         return db
 
 
 class LocalLLM(BaseLLM):
 
-    def _create_store(self, root_dir: str) -> Optional[FAISS]:
-        embeddings = HuggingFaceEmbeddings(model_name='all-MiniLM-L6-v2')
-        return self._create_vector_store(embeddings, MODEL_TYPES["LOCAL"], root_dir)
+    def _create_store(self, root_dir: str, force_recreate: bool = False) -> Optional[FAISS]:
+        # Imported here so OpenAI-only runs never load torch and sentence-transformers
+        from embeddings import create_local_embeddings
+        model_name = "all-MiniLM-L6-v2"
+        embeddings = create_local_embeddings(self.config, model_name)
+        metadata = {"embedding_model": model_name, "embedding_dim": None}
+        return self._create_vector_store(embeddings, MODEL_TYPES["LOCAL"], root_dir, metadata, force_recreate)
 
     def _create_model(self):
-        llm = GPT4All(model=self.config.get("model_path"), n_ctx=int(self.config.get("max_tokens")), streaming=True)
+        llm = GPT4All(model=self.config.get("model_path"), n_ctx=int(self.config.get("max_tokens")), streaming=True,
+                      n_threads=os.cpu_count(), n_batch=int(self.config.get("n_batch")))
         return llm
 
     def send_query(self, query):
@@ -88,14 +146,20 @@ class LocalLLM(BaseLLM):
 
         llm_chain.run(query)
 
-        file_paths = [os.path.abspath(s.metadata["source"]) for s in docs]
-        sys.stderr.write('\n'.join([f'{file_path}:' for file_path in file_paths]))
+        file_paths = map(os.path.abspath, (s.metadata["source"] for s in docs))
+        sys.stderr.write("".join(f"{file_path}:\n" for file_path in file_paths))
 
 
 class OpenAILLM(BaseLLM):
     def _create_store(self, root_dir: str, force_recreate: bool = False) -> Optional[FAISS]:
-        embeddings = OpenAIEmbeddings(openai_api_key=self.config.get("api_key"))
-        return self._create_vector_store(embeddings, MODEL_TYPES["OPENAI"], root_dir, force_recreate)
+        embedding_model = self.config.get("embedding_model")
+        embedding_dim = self.config.get("embedding_dim")
+        # Only the text-embedding-3 models accept a truncated output dimension
+        embedding_dim = int(embedding_dim) if embedding_model.startswith("text-embedding-3") and embedding_dim else None
+        embeddings = AsyncBatchOpenAIEmbeddings(model=embedding_model, dimensions=embedding_dim,
+                                                openai_api_key=self.config.get("api_key"))
+        metadata = {"embedding_model": embedding_model, "embedding_dim": embedding_dim}
+        return self._create_vector_store(embeddings, MODEL_TYPES["OPENAI"], root_dir, metadata, force_recreate)
 
     def _create_model(self):
         return ChatOpenAI(model_name=self.config.get("model_name"),
@@ -119,10 +183,8 @@ class OpenAILLM(BaseLLM):
 
         self.llm(messages)
         
-        file_paths = [os.path.abspath(s.metadata["source"]) for s in docs]
-        sys.stderr.write(f"AI prompt:\n{prompt}")
-        sys.stderr.write(f"User query:\n{query}")
-        sys.stderr.write(f"Relevant files:\n{file_paths}")
+        file_paths = list(map(os.path.abspath, (s.metadata["source"] for s in docs)))
+        sys.stderr.write(f"AI prompt:\n{prompt}\nUser query:\n{query}\nRelevant files:\n{file_paths}\n")
 
 def factory_llm(root_dir, config):
     model_type = config.get("model_type")
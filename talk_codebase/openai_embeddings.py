@@ -0,0 +1,63 @@
+# openai_embeddings.py
+
+import asyncio
+import os
+from typing import List, Optional
+
+import openai
+from langchain.embeddings import OpenAIEmbeddings
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from utils import get_encoding
+
+
+class AsyncBatchOpenAIEmbeddings(OpenAIEmbeddings):
+    batch_size: int = 512
+    max_concurrency: int = 8
+    # OpenAI rejects embedding requests over 300k tokens in total, keep a margin for tokenizer drift
+    max_batch_tokens: int = 200_000
+    dimensions: Optional[int] = None
+
+    def embed_documents(self, texts: List[str], chunk_size: int = 0) -> List[List[float]]:
+        return asyncio.run(self._aembed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return asyncio.run(self._aembed_documents([text]))[0]
+
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # The semaphore caps in-flight requests so bursts stay under the rate limit
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        params = self._invocation_params
+        if self.openai_api_type not in ("azure", "azure_ad", "azuread"):
+            # The engine only names Azure deployments, OpenAI itself picks the model from `model`
+            del params["engine"]
+        if self.dimensions:
+            params["dimensions"] = self.dimensions
+
+        @retry(retry=retry_if_exception_type((openai.error.Timeout, openai.error.APIError,
+                                              openai.error.APIConnectionError, openai.error.RateLimitError,
+                                              openai.error.ServiceUnavailableError)),
+               wait=wait_exponential(min=1, max=60), stop=stop_after_attempt(self.max_retries), reraise=True)
+        async def embed_batch(batch):
+            async with semaphore:
+                response = await openai.Embedding.acreate(input=batch, model=self.model, **params)
+            return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+        tokens = get_encoding(self.model).encode_batch(texts, num_threads=os.cpu_count(), disallowed_special=())
+        token_counts = [len(t) for t in tokens]
+        batches = []
+        batch, batch_tokens = [], 0
+        for i in sorted(range(len(texts)), key=lambda i: token_counts[i]):
+            if batch and (len(batch) == self.batch_size or batch_tokens + token_counts[i] > self.max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += token_counts[i]
+        if batch:
+            batches.append(batch)
+        results = await asyncio.gather(*(embed_batch([texts[i] for i in batch]) for batch in batches))
+        embeddings = [None] * len(texts)
+        for batch, vectors in zip(batches, results):
+            for i, vector in zip(batch, vectors):
+                embeddings[i] = vector
+        return embeddings
@@ -1,16 +1,40 @@
 # utils.py
 
+import functools
 import glob
+import hashlib
 import multiprocessing
 import os
+import pickle
+import platform
+import sqlite3
 import sys
 import json
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
 import tiktoken
 from git import Repo
 from langchain import FAISS
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from tqdm import tqdm
 
-from consts import LOADER_MAPPING, EXCLUDE_FILES
+try:
+    from semantic_text_splitter import TextSplitter
+except ImportError:
+    TextSplitter = None
+
+from consts import LOADER_MAPPING, EXCLUDE_FILES, CHUNK_MANIFEST, STORE_METADATA, EMBED_BATCH_SIZE, EMBEDDING_PRICES
+
+
+def is_enabled(config, key):
+    return str(config.get(key)).lower() in ("true", "yes", "1")
 
 
 def get_repo(root_dir):
@@ -63,39 +87,350 @@ class StreamStdOutJSON(StreamingStdOutCallbackHandler):
         sys.stdout.flush()
 
 
+def iter_loaders(root_dir, log=True):
+    for file_path in glob.glob(os.path.join(root_dir, '**/*'), recursive=True):
+        if is_ignored(file_path, root_dir):
+            continue
+        if any(
+                file_path.endswith(exclude_file) for exclude_file in EXCLUDE_FILES):
+            continue
+        for ext in LOADER_MAPPING:
+            if file_path.endswith(ext):
+                if log:
+                    sys.stderr.write('\r' + f'Loading files: {file_path}')
+                args = LOADER_MAPPING[ext]['args']
+                yield LOADER_MAPPING[ext]['loader'](file_path, **args)
+
+
 def load_files(root_dir):
     num_cpus = multiprocessing.cpu_count()
     with multiprocessing.Pool(num_cpus) as pool:
-        futures = []
-        for file_path in glob.glob(os.path.join(root_dir, '**/*'), recursive=True):
-            if is_ignored(file_path, root_dir):
-                continue
-            if any(
-                    file_path.endswith(exclude_file) for exclude_file in EXCLUDE_FILES):
-                continue
-            for ext in LOADER_MAPPING:
-                if file_path.endswith(ext):
-                    sys.stderr.write('\r' + f'Loading files: {file_path}')
-                    args = LOADER_MAPPING[ext]['args']
-                    loader = LOADER_MAPPING[ext]['loader'](file_path, **args)       
-                    futures.append(pool.apply_async(loader.load))
+        futures = [pool.apply_async(loader.load) for loader in iter_loaders(root_dir)]
         docs = []
         for future in futures:
             docs.extend(future.get())
     return docs
 
 
+def load_and_embed(root_dir, split, embeddings, batch_size=EMBED_BATCH_SIZE):
+    # Files are loaded and split on a worker thread while the main thread embeds, so disk and
+    # splitter work overlap with the embedding calls instead of running before them
+    chunks = queue.Queue(maxsize=64)
+    done = object()
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+                # On a terminal the tqdm bar owns the line, per-file messages would garble it
+                loaders = iter_loaders(root_dir, log=not sys.stderr.isatty())
+                futures = [pool.apply_async(loader.load) for loader in loaders]
+                for future in futures:
+                    if cancelled.is_set():
+                        return
+                    put(split(future.get()))
+        finally:
+            put(done)
+
+    texts = []
+    xb = None
+    pending = []
+
+    def embed(batch):
+        nonlocal xb
+        vectors = np.asarray(embeddings.embed_documents([text.page_content for text in batch]), dtype=np.float32)
+        n = len(texts)
+        if xb is None:
+            xb = np.empty((max(len(vectors), 1024), vectors.shape[1]), dtype=np.float32)
+        elif n + len(vectors) > len(xb):
+            grown = np.empty((max(2 * len(xb), n + len(vectors)), xb.shape[1]), dtype=np.float32)
+            grown[:n] = xb[:n]
+            xb = grown
+        xb[n:n + len(vectors)] = vectors
+        texts.extend(batch)
+        progress.update(len(batch))
+
+    with ThreadPoolExecutor(max_workers=1) as executor, tqdm(desc="Embedding chunks", unit="chunk",
+                                                           disable=not sys.stderr.isatty()) as progress:
+        producer = executor.submit(produce)
+        try:
+            while True:
+                item = chunks.get()
+                if item is done:
+                    break
+                pending.extend(item)
+                while len(pending) >= batch_size:
+                    embed(pending[:batch_size])
+                    pending = pending[batch_size:]
+            if pending:
+                embed(pending)
+        except BaseException:
+            cancelled.set()
+            raise
+        producer.result()
+
+    return texts, xb[:len(texts)] if xb is not None else None
+
+
+def embed_texts(texts, embeddings, batch_size=EMBED_BATCH_SIZE):
+    xb = None
+    with tqdm(total=len(texts), desc="Embedding chunks", unit="chunk", disable=not sys.stderr.isatty()) as progress:
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            vectors = np.asarray(embeddings.embed_documents([text.page_content for text in batch]), dtype=np.float32)
+            if xb is None:
+                xb = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            xb[start:start + len(batch)] = vectors
+            progress.update(len(batch))
+    return xb
+
+
+def split_documents(docs, config):
+    chunk_size = int(config.get("chunk_size"))
+    chunk_overlap = int(config.get("chunk_overlap"))
+    if TextSplitter is not None:
+        text_splitter = TextSplitter(capacity=chunk_size, overlap=chunk_overlap)
+        return [Document(page_content=chunk, metadata=dict(doc.metadata))
+                for doc in docs for chunk in text_splitter.chunks(doc.page_content)]
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(docs)
+
+
+class SplitCache:
+    # Chunks per source file, keyed by a hash of its contents and the splitter settings
+
+    def __init__(self, path, config):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.config = config
+        # The build pipeline splits on a worker thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS splits "
+                                "(path TEXT PRIMARY KEY, mtime REAL, sha256 TEXT, chunks BLOB)")
+
+    def _digest(self, docs):
+        sha256 = hashlib.sha256()
+        sha256.update(f"{TextSplitter is not None}:{self.config.get('chunk_size')}:"
+                      f"{self.config.get('chunk_overlap')}".encode("utf-8"))
+        for doc in docs:
+            sha256.update(doc.page_content.encode("utf-8"))
+        return sha256.hexdigest()
+
+    def split(self, docs):
+        docs_by_source = {}
+        for doc in docs:
+            docs_by_source.setdefault(doc.metadata["source"], []).append(doc)
+
+        texts = []
+        for source, source_docs in docs_by_source.items():
+            digest = self._digest(source_docs)
+            row = self.connection.execute("SELECT sha256, chunks FROM splits WHERE path = ?", (source,)).fetchone()
+            if row is not None and row[0] == digest:
+                texts.extend(pickle.loads(row[1]))
+                continue
+            chunks = split_documents(source_docs, self.config)
+            try:
+                mtime = os.path.getmtime(source)
+            except OSError:
+                mtime = None
+            self.connection.execute("INSERT OR REPLACE INTO splits VALUES (?, ?, ?, ?)",
+                                    (source, mtime, digest, pickle.dumps(chunks)))
+            texts.extend(chunks)
+        self.connection.commit()
+        return texts
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # Older tiktoken releases don't know the text-embedding-3 models, they all use cl100k_base
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# (model_name, source, mtime, chunk count) -> token count
+_token_counts = {}
+
+
 def calculate_cost(texts, model_name):
-    enc = tiktoken.encoding_for_model(model_name)
-    all_text = ''.join([text.page_content for text in texts])
-    tokens = enc.encode(all_text)
-    token_count = len(tokens)
-    cost = (token_count / 1000) * 0.0004
+    enc = get_encoding(model_name)
+    contents_by_source = {}
+    for text in texts:
+        contents_by_source.setdefault(text.metadata["source"], []).append(text.page_content)
+
+    token_count = 0
+    uncached = []
+    for source, contents in contents_by_source.items():
+        try:
+            key = (model_name, source, os.path.getmtime(source), len(contents))
+        except OSError:
+            key = None
+        if key in _token_counts:
+            token_count += _token_counts[key]
+        else:
+            uncached.append((key, contents))
+
+    tokens = enc.encode_batch([content for _, contents in uncached for content in contents],
+                              num_threads=os.cpu_count(), disallowed_special=())
+    offset = 0
+    for key, contents in uncached:
+        count = sum(len(t) for t in tokens[offset:offset + len(contents)])
+        offset += len(contents)
+        if key is not None:
+            _token_counts[key] = count
+        token_count += count
+
+    cost = (token_count / 1000) * EMBEDDING_PRICES.get(model_name, EMBEDDING_PRICES["text-embedding-ada-002"])
     return cost
 
 
+def create_vector_store(texts, vectors, embeddings, config):
+    # Embeddings are L2-normalized, so inner product ranks exactly like cosine similarity
+    faiss.normalize_L2(vectors)
+    nlist = int(config.get("nlist"))
+    index_type = config.get("index_type")
+    # 4-bit fast scan codes have 16 centroids per sub-quantizer, 8-bit codes have 256
+    ksub = 16 if index_type == "ivfpqfs" else 256
+    # k-means needs ~39 training points per centroid, both for the coarse quantizer and for every
+    # PQ sub-quantizer, small repos stay on the flat index
+    if index_type in ("ivfpq", "ivfpqfs") and len(texts) >= max(nlist, ksub) * 39:
+        m = int(config.get("pq_m"))
+        if index_type == "ivfpqfs":
+            # 4-bit codes let PQ fast scan keep the distance lookup tables in SIMD registers
+            factory = f"IVF{nlist},PQ{m}x4fs"
+        else:
+            factory = f"IVF{nlist},PQ{m}x8"
+        index = faiss.index_factory(vectors.shape[1], factory, faiss.METRIC_INNER_PRODUCT)
+        # k-means only needs a sample; faiss itself caps training at 256 points per centroid
+        n_train = min(len(texts), max(nlist, ksub) * 256, 100_000)
+        sample = np.random.default_rng(0).choice(len(texts), n_train, replace=False)
+        index.train(vectors[np.sort(sample)])
+    else:
+        index = faiss.IndexFlatIP(vectors.shape[1])
+    db = FAISS(embedding_function=embeddings.embed_query, index=index, docstore=InMemoryDocstore({}),
+               index_to_docstore_id={}, normalize_L2=True)
+    add_vectors(db, texts, vectors)
+    return db
+
+
+def check_faiss_simd():
+    if platform.machine().lower() not in ("x86_64", "amd64"):
+        return
+    if "AVX2" not in faiss.get_compile_options():
+        sys.stderr.write("faiss was built without AVX2, index build and search will use the slow reference kernels")
+
+
+def set_nprobe(db, nprobe):
+    ivf = faiss.try_extract_index_ivf(db.index)
+    if ivf is not None:
+        ivf.nprobe = nprobe
+
+
 def get_local_vector_store(embeddings, path):
+    # The index is memory-mapped read-only so startup doesn't copy it into RAM,
+    # call reopen_writable before mutating it
     try:
-        return FAISS.load_local(path, embeddings)
+        index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
     except:
         return None
+    return FAISS(embedding_function=embeddings.embed_query, index=index, docstore=docstore,
+                 index_to_docstore_id=index_to_docstore_id, normalize_L2=True)
+
+
+def reopen_writable(db, path):
+    db.index = faiss.read_index(os.path.join(path, "index.faiss"))
+
+
+def chunk_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def build_chunk_manifest(db):
+    # {source: {chunk hash: [docstore ids]}}
+    manifest = {}
+    for docstore_id in db.index_to_docstore_id.values():
+        doc = db.docstore.search(docstore_id)
+        hashes = manifest.setdefault(doc.metadata["source"], {})
+        hashes.setdefault(chunk_hash(doc.page_content), []).append(docstore_id)
+    return manifest
+
+
+def save_chunk_manifest(db, path):
+    with open(os.path.join(path, CHUNK_MANIFEST), "w") as f:
+        json.dump(build_chunk_manifest(db), f)
+
+
+def load_chunk_manifest(db, path):
+    try:
+        with open(os.path.join(path, CHUNK_MANIFEST), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return build_chunk_manifest(db)
+
+
+def save_store_metadata(path, metadata):
+    # The embedding model and dimension the stored vectors were built with
+    with open(os.path.join(path, STORE_METADATA), "w") as f:
+        json.dump(metadata, f)
+
+
+def load_store_metadata(path):
+    try:
+        with open(os.path.join(path, STORE_METADATA), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def supports_removal(db):
+    # Fast scan keeps its codes in block inverted lists, removing from those aborts the process
+    # in faiss 1.7.4 instead of raising, so it has to be checked up front
+    ivf = faiss.try_extract_index_ivf(db.index)
+    return ivf is None or not isinstance(faiss.downcast_index(ivf), faiss.IndexIVFFastScan)
+
+
+def remove_from_vector_store(db, docstore_ids):
+    docstore_ids = set(docstore_ids)
+    faiss_ids = [i for i, docstore_id in db.index_to_docstore_id.items() if docstore_id in docstore_ids]
+    db.index.remove_ids(np.array(faiss_ids, dtype=np.int64))
+    if faiss.try_extract_index_ivf(db.index) is None:
+        # Flat indexes compact the remaining vectors, so their positions shift down
+        kept = [docstore_id for _, docstore_id in sorted(db.index_to_docstore_id.items())
+                if docstore_id not in docstore_ids]
+        db.index_to_docstore_id = dict(enumerate(kept))
+    else:
+        # IVF lists keep the original ids of the remaining vectors
+        for i in faiss_ids:
+            del db.index_to_docstore_id[i]
+    for docstore_id in docstore_ids:
+        db.docstore._dict.pop(docstore_id, None)
+
+
+def add_to_vector_store(db, texts, embeddings):
+    vectors = np.array(embeddings.embed_documents([text.page_content for text in texts]), dtype=np.float32)
+    if getattr(db, "_normalize_L2", False):
+        faiss.normalize_L2(vectors)
+    add_vectors(db, texts, vectors)
+
+
+def add_vectors(db, texts, vectors):
+    # One bulk add into the index, bypassing langchain's per-document add path
+    start = max(db.index_to_docstore_id, default=-1) + 1
+    ids = np.arange(start, start + len(texts), dtype=np.int64)
+    if faiss.try_extract_index_ivf(db.index) is None:
+        db.index.add(vectors)
+    else:
+        db.index.add_with_ids(vectors, ids)
+    docstore_ids = [str(uuid.uuid4()) for _ in texts]
+    db.docstore.add(dict(zip(docstore_ids, texts)))
+    db.index_to_docstore_id.update(zip(ids.tolist(), docstore_ids))
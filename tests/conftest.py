@@ -0,0 +1,5 @@
+import os
+import sys
+
+# talk_codebase modules import each other by bare name, the same way cli.py is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "talk_codebase"))
@@ -0,0 +1,120 @@
+import hashlib
+
+import faiss
+import numpy as np
+import pytest
+from langchain import FAISS
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.embeddings.base import Embeddings
+
+from consts import DEFAULT_CONFIG, MODEL_TYPES
+from llm import BaseLLM
+from utils import add_to_vector_store, add_vectors, remove_from_vector_store
+
+DIM = 16
+METADATA = {"embedding_model": "fake", "embedding_dim": None}
+
+
+class FakeEmbeddings(Embeddings):
+    # Deterministic unit vectors seeded by the text, so equal chunks embed identically
+
+    def _embed(self, text):
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class FakeLLM(BaseLLM):
+
+    def __init__(self, config):
+        self.config = config
+
+    def create_store(self, root_dir):
+        return self._create_vector_store(FakeEmbeddings(), MODEL_TYPES["LOCAL"], root_dir, METADATA)
+
+
+def write_sources(root_dir, names):
+    for name in names:
+        (root_dir / f"{name}.py").write_text(f"def {name}():\n    return '{name}'\n")
+
+
+def assert_consistent(db):
+    # Every faiss id maps to a stored chunk, and searching that chunk's own vector finds that id
+    assert db.index.ntotal == len(db.index_to_docstore_id) == len(db.docstore._dict)
+    embeddings = FakeEmbeddings()
+    for i, docstore_id in db.index_to_docstore_id.items():
+        doc = db.docstore.search(docstore_id)
+        vector = np.array([embeddings.embed_query(doc.page_content)], dtype=np.float32)
+        _, ids = db.index.search(vector, 1)
+        assert ids[0][0] == i
+
+
+def make_db(index, names):
+    db = FAISS(embedding_function=FakeEmbeddings().embed_query, index=index, docstore=InMemoryDocstore({}),
+               index_to_docstore_id={}, normalize_L2=True)
+    texts = [Document(page_content=name, metadata={"source": name}) for name in names]
+    add_vectors(db, texts, np.array(FakeEmbeddings().embed_documents(names), dtype=np.float32))
+    return db
+
+
+def flat_index():
+    return faiss.IndexFlatIP(DIM)
+
+
+def ivf_index():
+    index = faiss.index_factory(DIM, "IVF4,Flat", faiss.METRIC_INNER_PRODUCT)
+    index.train(np.random.default_rng(0).standard_normal((400, DIM)).astype(np.float32))
+    # Probing every list makes the search exact
+    index.nprobe = 4
+    return index
+
+
+@pytest.fixture
+def llm():
+    return FakeLLM(dict(DEFAULT_CONFIG, model_type=MODEL_TYPES["LOCAL"]))
+
+
+def test_create_vector_store_adds_each_chunk_once(llm, tmp_path):
+    write_sources(tmp_path, ["alpha", "beta", "gamma"])
+    db = llm.create_store(str(tmp_path))
+    assert db.index.ntotal == len(db.index_to_docstore_id) == 3
+    assert_consistent(db)
+
+
+def test_incremental_update_replaces_changed_chunks(llm, tmp_path):
+    write_sources(tmp_path, ["alpha", "beta", "gamma"])
+    llm.create_store(str(tmp_path))
+
+    (tmp_path / "alpha.py").unlink()
+    (tmp_path / "beta.py").write_text("def beta():\n    return 'changed'\n")
+    write_sources(tmp_path, ["delta"])
+    db = llm.create_store(str(tmp_path))
+
+    contents = sorted(doc.page_content for doc in db.docstore._dict.values())
+    assert contents == ["def beta():\n    return 'changed'", "def delta():\n    return 'delta'",
+                        "def gamma():\n    return 'gamma'"]
+    assert_consistent(db)
+
+
+@pytest.mark.parametrize("make_index", [flat_index, ivf_index])
+def test_remove_then_add_keeps_ids_aligned(make_index):
+    names = [f"chunk{i}" for i in range(10)]
+    db = make_db(make_index(), names)
+    by_content = {doc.page_content: docstore_id for docstore_id, doc in db.docstore._dict.items()}
+
+    remove_from_vector_store(db, [by_content["chunk2"], by_content["chunk5"]])
+    assert_consistent(db)
+    add_to_vector_store(db, [Document(page_content=name, metadata={"source": name}) for name in ["new0", "new1"]],
+                        FakeEmbeddings())
+
+    assert db.index.ntotal == 10
+    assert sorted(doc.page_content for doc in db.docstore._dict.values()) == sorted(
+        [name for name in names if name not in ("chunk2", "chunk5")] + ["new0", "new1"])
+    assert_consistent(db)